@@ -1,168 +1,646 @@
+import logging
+import logging.handlers
 import os
+import random
 import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import pytz
-import yfinance as yf
+from urllib.parse import unquote
+from zoneinfo import ZoneInfo
+import httpx
+import orjson
 from notion_client import Client
+from notion_client.errors import HTTPResponseError
 
 # ── 환경 변수 ─────────────────────────────────────────────
 NOTION_TOKEN = os.environ.get('NOTION_TOKEN')
 DATABASE_ID  = os.environ.get('DATABASE_ID')
-if not NOTION_TOKEN or not DATABASE_ID:
-    print("Error: NOTION_TOKEN, DATABASE_ID must be set")
-    sys.exit(1)
+
+# ── 로깅 ──────────────────────────────────────────────────
+log = logging.getLogger("update_stocks")
+LOG_BUFFER_SIZE = 50      # 이만큼 모아서 한 번에 출력
+
+def setup_logging():
+    """로그를 LOG_BUFFER_SIZE건씩 모아 stdout에 기록 (종료 시 logging.shutdown으로 flush)"""
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(logging.handlers.MemoryHandler(capacity=LOG_BUFFER_SIZE, target=target))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+# ── 동시성 ────────────────────────────────────────────────
+NOTION_MAX_WORKERS  = 5    # Notion 동시 업데이트 상한 (초당 3회 한도라 그 이상은 리미터 대기만 늘어남)
+QUOTE_BATCH_WORKERS = 8    # 동시에 진행할 Yahoo 배치 조회 수
+CHART_WORKERS       = 8    # 배치 누락분 chart 개별 조회 동시 실행 수
+
+# ── 스로틀링 ──────────────────────────────────────────────
+MAX_RETRIES    = 5        # 429·5xx 응답 시 최대 시도 횟수
+RETRY_STATUSES = (500, 502, 503, 504)   # 일시적 서버 오류 — 지수 백오프 후 재시도
+RETRY_BACKOFF  = 0.8      # 5xx 재시도 기본 대기(초), 시도마다 2배
+RETRY_AFTER_MAX = 30      # Retry-After가 이보다 길면(초) 기다리지 않고 해당 요청을 포기
+
+class AIMDThrottle:
+    """429 응답에 맞춰 호출 간격을 조절 (성공 시 가산 감소, 429 시 배수 증가)"""
+
+    def __init__(self, delay: float = 0.0, max_delay: float = 5.0, step: float = 0.05):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.step = step
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            delay = self.delay
+        if delay > 0:
+            time.sleep(delay * (1 + random.random() * 0.3))
+
+    def on_success(self):
+        with self._lock:
+            self.delay = max(0.0, self.delay - self.step)
+
+    def on_429(self):
+        # 호출 간격은 max_delay를 넘지 않는다 (Retry-After는 재시도하는 쪽에서 1회만 대기)
+        with self._lock:
+            self.delay = min(self.max_delay, self.delay * 2 or 0.2)
+
+def parse_retry_after(headers) -> float | None:
+    """Retry-After 헤더(초 단위)를 float으로 변환"""
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def backoff_sleep(attempt: int):
+    """5xx 재시도 대기 (지수 백오프 + 지터)"""
+    time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1) * (1 + random.random() * 0.3))
+
+notion_throttle = AIMDThrottle()
+yahoo_throttle  = AIMDThrottle()
+
+class GCRA:
+    """호스트별 호출 속도 제한 (GCRA: 초당 rate회, 최대 burst회 연속 허용)"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tat = 0.0            # 이론상 다음 도착 시각(theoretical arrival time)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tat = max(self.tat, now) + 1 / self.rate
+            wait = self.tat - now - self.burst / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+LIMITERS = {
+    "api.notion.com": GCRA(3.0, 5),                  # Notion 공개 한도: 평균 초당 3회
+    "query1.finance.yahoo.com": GCRA(100 / 60, 10),  # 분당 100회, 순간 10회까지
+}
+
+def _rate_limit(request: httpx.Request):
+    # httpx request 훅: 모든 요청이 전송 직전에 해당 호스트의 리미터를 통과
+    limiter = LIMITERS.get(request.url.host)
+    if limiter:
+        limiter.acquire()
 
 # ── Notion / TZ ───────────────────────────────────────────
-notion = Client(auth=NOTION_TOKEN)
-KST = pytz.timezone("Asia/Seoul")
+KST = ZoneInfo("Asia/Seoul")
+NOTION_PAGE_SIZE  = 100     # databases.query 1회당 최대 페이지 수 (API 상한)
+NOTION_TIMEOUT_MS = 15_000  # Notion 요청 타임아웃 (SDK 기본값 60초)
+TICKER_PROP_ID    = "title" # title 속성(티커)의 property id는 항상 "title"
+VALUE_PROPS       = ("현재가", "전일종가", "시가총액", "USDKRW")   # 변동 여부를 비교할 숫자 속성
+VALUE_EPSILON     = 0.005   # 이 차이 미만이면 같은 값으로 간주 (가격은 센트 단위까지만 의미)
+UPDATED_PROP      = "업데이트시간"
+PAGE_MAX_AGE      = float(os.environ.get("PAGE_MAX_AGE_HOURS", "24")) * 3600   # 값이 같아도 이보다 오래된 페이지는 다시 기록(초)
+
+def make_notion_client() -> Client:
+    # 모든 Notion 호출이 하나의 커넥션 풀(keep-alive)을 공유하고,
+    # HTTP/2로 동시 업데이트를 연결 하나에 다중화.
+    # keep-alive 상한을 전체 상한과 같게 두어 업데이트 사이에 연결을 닫지 않는다
+    http = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+        event_hooks={"request": [_rate_limit]},
+    )
+    return Client(auth=NOTION_TOKEN, client=http, timeout_ms=NOTION_TIMEOUT_MS)
+
+# ── Yahoo ─────────────────────────────────────────────────
+YF_QUOTE_URL  = "https://query1.finance.yahoo.com/v7/finance/quote"
+YF_CHART_URL  = "https://query1.finance.yahoo.com/v8/finance/chart/{}"
+YF_CRUMB_URL  = "https://query1.finance.yahoo.com/v1/test/getcrumb"
+YF_COOKIE_URL = "https://fc.yahoo.com"
+USDKRW_SYMBOL = "USDKRW=X"
+QUOTE_BATCH_SIZE = 100    # quote 요청 1회당 최대 티커 수
+YAHOO_CONNECT_RETRIES = 3
+YAHOO_TIMEOUT    = 10     # 요청 타임아웃(초)
+
+def make_yahoo_client() -> httpx.Client:
+    # Accept-Encoding은 httpx 기본값 사용 — brotli 설치 시 "gzip, deflate, br"
+    return httpx.Client(
+        # 연결 단계 오류(DNS·TCP·TLS)는 transport에서 재시도
+        transport=httpx.HTTPTransport(
+            http2=True,
+            retries=YAHOO_CONNECT_RETRIES,
+            # 배치·chart 워커가 동시에 쓰는 연결을 모두 유지하고, Notion 페이지 응답을
+            # 기다리는 사이(수 초)에 유휴 연결이 닫히지 않도록 만료 시간을 늘린다
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=30),
+        ),
+        headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"},
+        timeout=YAHOO_TIMEOUT,
+        follow_redirects=True,
+        event_hooks={"request": [_rate_limit]},
+    )
+
+# import 시에는 만들지 않고 첫 Yahoo 요청 때 yahoo_http()가 생성 (모든 워커가 공유)
+YAHOO_HTTP = None
+_yahoo_http_lock = threading.Lock()
+
+def yahoo_http() -> httpx.Client:
+    global YAHOO_HTTP
+    with _yahoo_http_lock:
+        if YAHOO_HTTP is None:
+            YAHOO_HTTP = make_yahoo_client()
+        return YAHOO_HTTP
+
+_crumb = None   # None: 아직 발급 전, "": 발급 실패 (실행당 1회만 시도)
+_crumb_lock = threading.Lock()
+
+# ── 캐시 ──────────────────────────────────────────────────
+CACHE_DIR    = ".cache"
+USDKRW_CACHE = os.path.join(CACHE_DIR, "usdkrw.json")
+USDKRW_TTL   = int(os.environ.get("USDKRW_TTL", "3600"))   # 환율 캐시 유효시간(초)
+QUOTE_CACHE  = os.path.join(CACHE_DIR, "quotes.json")
+QUOTE_TTL    = int(os.environ.get("QUOTE_TTL", "60"))      # 시세 캐시 유효시간(초)
 
-def fetch_all_pages(database_id: str):
-    pages, start = [], None
+def load_cache(path: str) -> dict:
+    """JSON 캐시 파일 로드 (없거나 깨졌으면 빈 dict)"""
+    try:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(path: str, data: dict):
+    """JSON 캐시 파일 저장 (실패해도 실행은 계속)"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(data))
+    except OSError as e:
+        log.info(f"캐시 저장 실패 ({path}): {e}")
+
+class QuoteCache:
+    """티커별 시세 TTL 캐시 (실행 간에는 디스크에 유지, 스레드 간 공유)"""
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._data = load_cache(path)   # 티커 → {"ts": epoch, "quote": {...}}
+        self._lock = threading.Lock()
+
+    def get_many(self, symbols) -> dict:
+        now = time.time()
+        out = {}
+        with self._lock:
+            for sym in symbols:
+                entry = self._data.get(sym)
+                if entry and now - entry.get("ts", 0) < self.ttl:
+                    out[sym] = entry["quote"]
+        return out
+
+    def put_many(self, quotes: dict):
+        now = time.time()
+        with self._lock:
+            for sym, quote in quotes.items():
+                self._data[sym] = {"ts": now, "quote": quote}
+
+    def invalidate(self, sym: str):
+        # Notion 반영에 실패한 티커는 다음 실행에서 새로 조회하도록 제거
+        with self._lock:
+            self._data.pop(sym, None)
+
+    def save(self):
+        # 만료된 항목은 버리고 저장
+        now = time.time()
+        with self._lock:
+            fresh = {k: v for k, v in self._data.items() if now - v.get("ts", 0) < self.ttl}
+        save_cache(self.path, fresh)
+
+def resolve_prop_ids(notion: Client, database_id: str) -> list:
+    """쿼리에 필요한 속성(티커 + 비교용 숫자 속성 + 업데이트시간)의 property id 목록"""
+    # API가 돌려주는 id는 이미 퍼센트 인코딩돼 있어(예: "%3AUPp") 그대로 넘기면 httpx가
+    # 한 번 더 인코딩하므로 원래 id로 되돌린다
+    props = notion.databases.retrieve(database_id=database_id).get("properties", {})
+    return [TICKER_PROP_ID] + [unquote(props[n]["id"]) for n in (*VALUE_PROPS, UPDATED_PROP) if n in props]
+
+def iter_page_batches(notion: Client, database_id: str, prop_ids: list):
+    """DB 페이지를 쿼리 응답 단위로 yield (다음 커서 요청 전에 호출자가 먼저 처리 가능)"""
+    # 티커가 비어 있는 행은 서버에서 걸러내고,
+    # 티커와 비교용 숫자 속성만 받아 응답 크기를 줄인다
+    ticker_filter = {"property": "티커", "title": {"is_not_empty": True}}
+    start = None   # None이면 SDK가 요청 본문에서 start_cursor를 뺀다
     while True:
-        kwargs = {"database_id": database_id}
-        if start:
-            kwargs["start_cursor"] = start
-            
-        resp = notion.databases.query(**kwargs)
-        
-        pages.extend(resp.get("results", []))
+        resp = notion.databases.query(
+            database_id=database_id,
+            start_cursor=start,
+            page_size=NOTION_PAGE_SIZE,
+            filter=ticker_filter,
+            filter_properties=prop_ids,
+        )
+        yield resp.get("results", [])
         if not resp.get("has_more"):
-            break
+            return
         start = resp.get("next_cursor")
-    return pages
 
 def parse_ticker_from_page(page: dict) -> str:
-    tp = page.get("properties", {}).get("티커", {})
-    if tp.get("type") != "title":
-        return ""
-    items = tp.get("title", [])
-    if not items:
+    # 정상 경로는 직접 인덱싱, 구조가 다르면 예외로 빈 값 처리
+    try:
+        items = page["properties"]["티커"]["title"]
+        if not items:
+            return ""
+        return items[0]["text"]["content"].strip().upper()
+    except (KeyError, IndexError, TypeError, AttributeError):
         return ""
-    t = (items[0].get("text", {}) or {}).get("content", "") or ""
-    return t.strip().upper()
 
-def fetch_yahoo_quotes(symbols):
-    """Yahoo Finance를 사용하여 주식 가격 조회"""
-    if not symbols:
+def parse_values_from_page(page: dict) -> tuple:
+    """페이지에 현재 기록된 (현재가, 전일종가, 시가총액, USDKRW, 업데이트시간), 없는 값은 None"""
+    props = page.get("properties") or {}
+    numbers = tuple((props.get(n) or {}).get("number") for n in VALUE_PROPS)
+    updated = ((props.get(UPDATED_PROP) or {}).get("date") or {}).get("start")
+    return numbers + (updated,)
+
+def is_unchanged(old: tuple, info: dict, usdkrw: float | None, now: datetime) -> bool:
+    """새 시세·환율이 페이지에 이미 기록된 값과 (허용 오차 내에서) 같고 기록이 오래되지 않았는지"""
+    *numbers, updated = old
+    # 업데이트시간이 없거나 PAGE_MAX_AGE보다 오래됐으면 값이 같아도 다시 기록
+    try:
+        if (now - datetime.fromisoformat(updated)).total_seconds() >= PAGE_MAX_AGE:
+            return False
+    except (TypeError, ValueError):
+        return False
+    new = (info["currentPrice"], info["previousClose"], info["marketCap"], usdkrw)
+    for o, n in zip(numbers, new):
+        if not n:
+            continue   # 기록하지 않는 값(0 = 시총 미상 등)은 비교 대상에서 제외
+        if o is None or abs(o - n) >= VALUE_EPSILON:
+            return False
+    return True
+
+def _make_quote(curr, prev, mcap, name) -> dict | None:
+    """원시 시세 값을 업데이트용 dict로 정규화 (현재가가 없으면 None)"""
+    if not curr or curr <= 0:
+        return None
+    curr = float(curr)
+    prev = float(prev or curr)
+    return {
+        "currentPrice": curr,
+        "previousClose": prev,
+        # 시가총액 (억 단위로 변환)
+        "marketCap": round(mcap / 100_000_000) if mcap and mcap > 0 else 0,
+        "name": name or "",
+        # 등락률(%) — 티커당 1회만 계산해 같은 티커의 모든 페이지 로그에 재사용
+        "changePct": round((curr - prev) / prev * 100, 2) if prev > 0 else 0.0,
+    }
+
+def yahoo_get(url: str, **kwargs) -> httpx.Response:
+    """Yahoo GET — 429면 Retry-After/AIMD 간격만큼, 5xx면 지수 백오프만큼 쉬고 최대 MAX_RETRIES회 시도"""
+    for attempt in range(1, MAX_RETRIES + 1):
+        yahoo_throttle.wait()
+        r = yahoo_http().get(url, **kwargs)
+        if r.status_code != 429 and r.status_code not in RETRY_STATUSES:
+            yahoo_throttle.on_success()
+            break
+        if attempt == MAX_RETRIES:
+            break
+        if r.status_code == 429:
+            yahoo_throttle.on_429()
+            retry_after = parse_retry_after(r.headers) or 0
+            if retry_after > RETRY_AFTER_MAX:
+                break   # 워커를 오래 붙잡지 않도록 429 응답 그대로 반환
+            time.sleep(retry_after)
+        else:
+            backoff_sleep(attempt)
+    return r
+
+def _yahoo_crumb() -> str:
+    """quote 엔드포인트용 crumb 발급 (실행당 1회, 쿠키는 Yahoo 클라이언트에 유지)"""
+    global _crumb
+    with _crumb_lock:
+        if _crumb is None:
+            _crumb = ""   # 실패하면 그대로 남아 이후 배치는 바로 개별 조회로 넘어감
+            try:
+                yahoo_http().get(YF_COOKIE_URL)   # 404여도 인증 쿠키는 설정됨
+            except httpx.HTTPError:
+                pass
+            r = yahoo_get(YF_CRUMB_URL)
+            r.raise_for_status()
+            _crumb = r.text.strip()
+        if not _crumb:
+            raise RuntimeError("crumb 발급 실패")
+        return _crumb
+
+# quote 응답에서 값을 찾을 키 우선순위
+_PRICE_KEYS      = ("regularMarketPrice", "currentPrice")
+_PREV_CLOSE_KEYS = ("regularMarketPreviousClose", "previousClose")
+_MCAP_KEYS       = ("marketCap",)
+_NUM_TYPES       = (int, float)
+
+def _first_number(obj: dict, keys):
+    """keys 순서대로 처음 나오는 숫자 값 (type 비교라 bool·dict 등은 건너뜀)"""
+    for k in keys:
+        v = obj.get(k)
+        if type(v) in _NUM_TYPES:
+            return v
+    return None
+
+def _fetch_quote_batch(symbols) -> dict:
+    """v7 quote 엔드포인트 1회 호출로 여러 티커 조회"""
+    r = yahoo_get(YF_QUOTE_URL, params={"symbols": ",".join(symbols), "crumb": _yahoo_crumb()})
+    r.raise_for_status()
+
+    out = {}
+    for q in (orjson.loads(r.content).get("quoteResponse") or {}).get("result") or []:
+        sym = (q.get("symbol") or "").upper()
+        quote = _make_quote(
+            _first_number(q, _PRICE_KEYS),
+            _first_number(q, _PREV_CLOSE_KEYS),
+            _first_number(q, _MCAP_KEYS),
+            q.get("longName") or q.get("shortName"),
+        )
+        if sym and quote:
+            out[sym] = quote
+    return out
+
+def _chunks(xs, n):
+    for i in range(0, len(xs), n):
+        yield xs[i:i + n]
+
+def _fetch_quote_chunk(chunk) -> dict:
+    """배치 1개 조회 (실패 시 빈 dict → 해당 티커는 개별 조회로 넘어감)"""
+    try:
+        return _fetch_quote_batch(chunk)
+    except Exception as e:
+        log.info(f"  배치 조회 실패({len(chunk)}개) → 개별 조회로 전환: {e}")
         return {}
 
+def _same_market_day(ts, meta: dict) -> bool:
+    """봉 시각 ts가 meta.regularMarketTime과 같은 거래일인지 (거래소 현지 날짜 기준, 알 수 없으면 True)"""
+    market_time = meta.get("regularMarketTime")
+    if type(ts) is not int or type(market_time) is not int:
+        return True
+    offset = meta.get("gmtoffset") or 0
+    return (ts + offset) // 86400 == (market_time + offset) // 86400
+
+def _fetch_chart_quote(sym: str):
+    """chart 엔드포인트(최근 5일 일봉)로 단일 티커 조회 (워커 스레드에서 실행)"""
+    try:
+        r = yahoo_get(YF_CHART_URL.format(sym), params={"range": "5d", "interval": "1d"})
+        r.raise_for_status()
+        result = orjson.loads(r.content)["chart"]["result"][0]
+        meta = result.get("meta") or {}
+        closes = result["indicators"]["quote"][0].get("close") or ()
+        stamps = result.get("timestamp") or ()
+        # 뒤에서부터 None이 아닌 종가 2개(최근, 그 전)와 최근 종가 봉의 시각만 찾는다
+        last = []
+        last_ts = None
+        for i in range(len(closes) - 1, -1, -1):
+            if closes[i] is not None:
+                if not last and i < len(stamps):
+                    last_ts = stamps[i]
+                last.append(closes[i])
+                if len(last) == 2:
+                    break
+        if not last:
+            log.info(f"  {sym}: 조회 실패 - 데이터 없음")
+            return sym, None
+        curr = _first_number(meta, _PRICE_KEYS)
+        if not curr:
+            curr = last[0]
+            prev = last[1] if len(last) > 1 else None
+        elif not _same_market_day(last_ts, meta):
+            # 오늘 봉의 종가가 아직 비어 있으면 마지막 종가가 곧 전일 종가
+            prev = last[0]
+        else:
+            prev = last[1] if len(last) > 1 else None
+        return sym, _make_quote(curr, prev, None, meta.get("longName") or meta.get("shortName"))
+    except Exception as e:
+        log.info(f"  {sym}: 조회 실패 - {e}")
+    return sym, None
+
+def _fetch_missing_quotes(symbols) -> dict:
+    """배치 응답에 없는 티커를 chart 엔드포인트로 개별 조회 (동시 실행)"""
     out = {}
-    for sym in symbols:
-        try:
-            ticker = yf.Ticker(sym)
-            info = ticker.info
-
-            # 현재가
-            curr = info.get("currentPrice") or info.get("regularMarketPrice") or 0.0
-            # 전일종가
-            prev = info.get("previousClose") or info.get("regularMarketPreviousClose") or curr
-            # 시가총액 (억 단위로 변환)
-            mcap = info.get("marketCap") or 0
-            mcap_eok = round(mcap / 100_000_000) if mcap and mcap > 0 else 0
-            # 종목명
-            name = info.get("longName") or info.get("shortName") or sym
-
-            if curr > 0:
-                out[sym] = {
-                    "currentPrice": float(curr),
-                    "previousClose": float(prev),
-                    "marketCap": mcap_eok,
-                    "name": name,
-                }
-        except Exception as e:
-            print(f"  {sym}: 조회 실패 - {e}")
-            continue
+    with ThreadPoolExecutor(max_workers=CHART_WORKERS) as ex:
+        for sym, quote in ex.map(_fetch_chart_quote, symbols):
+            if quote:
+                out[sym] = quote
+    return out
+
+def fetch_yahoo_quotes(symbols, cache: QuoteCache | None = None):
+    """Yahoo Finance 배치 quote로 일괄 조회하고, 누락된 티커만 보조 경로로 조회"""
+    cached = cache.get_many(symbols) if cache else {}
+    symbols = [s for s in symbols if s not in cached]
+    if not symbols:
+        return cached
 
+    # URL 길이 제한을 피하도록 QUOTE_BATCH_SIZE개씩 나눠 동시에 조회
+    out = {}
+    with ThreadPoolExecutor(max_workers=QUOTE_BATCH_WORKERS) as ex:
+        futures = [ex.submit(_fetch_quote_chunk, chunk) for chunk in _chunks(symbols, QUOTE_BATCH_SIZE)]
+        for f in as_completed(futures):
+            out.update(f.result())
+
+    missing = [s for s in symbols if s not in out]
+    if missing:
+        out.update(_fetch_missing_quotes(missing))
+
+    if cache:
+        cache.put_many(out)
+    out.update(cached)
     return out
 
-def fetch_usdkrw():
+def _fetch_usdkrw_remote():
     """Yahoo Finance를 사용하여 USDKRW 환율 조회"""
+    quote = fetch_yahoo_quotes([USDKRW_SYMBOL]).get(USDKRW_SYMBOL)
+    return quote["currentPrice"] if quote else None
+
+def fetch_usdkrw():
+    """USDKRW 환율 조회 (TTL 이내면 디스크 캐시 사용)"""
+    cached = load_cache(USDKRW_CACHE)
     try:
-        ticker = yf.Ticker("USDKRW=X")
-        info = ticker.info
-        # 현재 환율
-        rate = info.get("regularMarketPrice") or info.get("currentPrice")
-        if rate:
-            return float(rate)
-    except Exception:
+        if time.time() - cached["ts"] < USDKRW_TTL:
+            return float(cached["rate"])
+    except (KeyError, TypeError, ValueError):
         pass
-    return None
 
-def update_notion_page(page_id: str, stock: dict, usdkrw: float | None):
+    rate = _fetch_usdkrw_remote()
+    if rate:
+        save_cache(USDKRW_CACHE, {"ts": time.time(), "rate": rate})
+    return rate
+
+def _build_props(stock: dict, usdkrw: float | None, now_iso: str) -> dict:
     props = {
         "현재가": {"number": stock["currentPrice"]},
         "전일종가": {"number": stock["previousClose"] if stock["previousClose"] > 0 else stock["currentPrice"]},
-        "시가총액": {"number": stock["marketCap"]},
-        "업데이트시간": {"date": {"start": datetime.now(KST).isoformat()}},
-        "종목명": {"rich_text": [{"text": {"content": stock.get("name","")}}]},
+        "업데이트시간": {"date": {"start": now_iso}},
     }
+    # 보조 경로(chart)에는 시가총액이 없으므로 알 때만 기록
+    if stock["marketCap"] > 0:
+        props["시가총액"] = {"number": stock["marketCap"]}
+    if stock.get("name"):
+        props["종목명"] = {"rich_text": [{"text": {"content": stock["name"]}}]}
     if isinstance(usdkrw, (int, float)) and usdkrw > 0:
         props["USDKRW"] = {"number": float(usdkrw)}
-    notion.pages.update(page_id=page_id, properties=props)
-
-def main():
-    print("=== 주식 가격 업데이트 시작 ===")
-    print(f"시간: {datetime.now(KST).strftime('%Y-%m-%d %H:%M:%S KST')}\n")
+    return props
 
-    pages = fetch_all_pages(DATABASE_ID)
-    if not pages:
-        print("데이터베이스에 항목이 없습니다.")
-        return
-    print(f"총 {len(pages)}개 종목 발견\n")
-
-    # 환율 1회 조회
-    usdkrw = fetch_usdkrw()
-    if usdkrw:
-        print(f"USDKRW: {usdkrw:.2f}")
-
-    # 티커 수집
-    rows, symbols = [], []
-    for p in pages:
-        t = parse_ticker_from_page(p)
-        if not t:
-            print(f"티커 없음 → 건너뜀 ({p['id']})")
+def update_notion_page(notion: Client, page_id: str, stock: dict, usdkrw: float | None, now_iso: str):
+    props = _build_props(stock, usdkrw, now_iso)
+    for attempt in range(1, MAX_RETRIES + 1):
+        notion_throttle.wait()
+        try:
+            notion.pages.update(page_id=page_id, properties=props)
+        except HTTPResponseError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            if e.status == 429:
+                notion_throttle.on_429()
+                retry_after = parse_retry_after(e.headers) or 0
+                if retry_after > RETRY_AFTER_MAX:
+                    raise   # 워커를 오래 붙잡지 않도록 이 페이지는 실패 처리
+                time.sleep(retry_after)
+            elif e.status in RETRY_STATUSES:
+                backoff_sleep(attempt)
+            else:
+                raise
             continue
-        rows.append((p["id"], t))
-        symbols.append(t)
-
-    if not rows:
-        print("유효한 티커가 없습니다.")
+        notion_throttle.on_success()
         return
 
-    # Yahoo Finance 조회
-    uniq = sorted(set(symbols))
-    print(f"\nYahoo Finance 조회 시작: {len(uniq)}개 티커")
-    try:
-        data_map = fetch_yahoo_quotes(uniq)
-        print(f"조회 완료: {len(data_map)}개 성공\n")
-    except Exception as e:
-        print(f"Yahoo Finance 조회 실패: {e}")
+def bulk_update_pages(notion: Client, updates, usdkrw: float | None, now_iso: str):
+    """(key, page_id, stock) 목록을 동시에 반영하고 끝나는 순서대로 (key, 예외 또는 None)을 yield.
+    updates는 제너레이터여도 되며, 꺼내는 즉시 제출하므로 조회와 쓰기가 겹친다.
+    Notion에 일괄 업데이트 API가 생기면 이 함수만 바꾸면 된다"""
+    with ThreadPoolExecutor(max_workers=NOTION_MAX_WORKERS) as ex:
+        futures = {
+            ex.submit(update_notion_page, notion, pid, stock, usdkrw, now_iso): key
+            for key, pid, stock in updates
+        }
+        for f in as_completed(futures):
+            yield futures[f], f.exception()
+
+def main():
+    if not NOTION_TOKEN or not DATABASE_ID:
+        log.error("Error: NOTION_TOKEN, DATABASE_ID must be set")
         sys.exit(1)
+    notion = make_notion_client()
 
-    # 페이지별 업데이트
-    ok = fail = 0
-    for i, (pid, sym) in enumerate(rows, start=1):
-        info = data_map.get(sym)
-        if not info or info["currentPrice"] <= 0:
-            print(f"[{i}/{len(rows)}] {sym} ✗ 데이터 없음/오류")
-            fail += 1
-            continue
-        try:
-            update_notion_page(pid, info, usdkrw)
-            chg = 0.0
-            if info["previousClose"] > 0:
-                chg = round((info["currentPrice"] - info["previousClose"]) / info["previousClose"] * 100, 2)
+    # 실행 시각은 1회만 계산해 모든 페이지의 업데이트시간에 재사용
+    now = datetime.now(KST)
+    now_iso = now.isoformat()
+    log.info("=== 주식 가격 업데이트 시작 ===")
+    log.info(f"시간: {now.strftime('%Y-%m-%d %H:%M:%S KST')}\n")
+
+    # 티커 수집 + Yahoo Finance 조회
+    # Notion 페이지네이션 응답이 올 때마다 새 티커의 시세 조회를 바로 던져
+    # 다음 페이지 요청 대기 시간과 Yahoo 조회 시간을 겹친다
+    # 같은 티커가 여러 페이지에 있어도 Yahoo 조회는 1회만 하고 결과를 모든 페이지에 적용
+    rows_by_sym = defaultdict(list)   # 티커 → [(행 번호, page_id, 기존 값), ...]
+    futures = []
+    total_pages = total_rows = 0
+    quote_cache = QuoteCache(QUOTE_CACHE, QUOTE_TTL)
+    with ThreadPoolExecutor(max_workers=QUOTE_BATCH_WORKERS) as quote_ex:
+        # 환율(1회 조회)은 페이지·시세 조회와 독립적이므로 처음부터 함께 진행
+        fx_future = quote_ex.submit(fetch_usdkrw)
+
+        prop_ids = resolve_prop_ids(notion, DATABASE_ID)
+        for batch in iter_page_batches(notion, DATABASE_ID, prop_ids):
+            total_pages += len(batch)
+            new_syms = []
+            for p in batch:
+                t = parse_ticker_from_page(p)
+                if not t:
+                    log.info(f"티커 없음 → 건너뜀 ({p['id']})")
+                    continue
+                total_rows += 1
+                if t not in rows_by_sym:
+                    new_syms.append(t)
+                rows_by_sym[t].append((total_rows, p["id"], parse_values_from_page(p)))
+            if new_syms:
+                futures.append(quote_ex.submit(fetch_yahoo_quotes, sorted(new_syms), quote_cache))
+
+        if not total_pages:
+            log.info("데이터베이스에 항목이 없습니다.")
+            return
+        log.info(f"총 {total_pages}개 종목 발견")
+
+        if not total_rows:
+            log.info("유효한 티커가 없습니다.")
+            return
+
+        usdkrw = fx_future.result()
+        if usdkrw:
+            log.info(f"USDKRW: {usdkrw:.2f}")
+
+        # 페이지별 업데이트 (Notion 호출은 스레드 풀에서 동시에 실행)
+        # 시세 배치가 도착하는 대로 해당 페이지 업데이트를 바로 던져
+        # 남은 Yahoo 조회와 Notion 쓰기를 겹친다.
+        # 페이지에 이미 기록된 값(시세·환율)과 같고 업데이트시간이 오래되지 않았으면
+        # Notion 호출 자체를 생략
+        log.info(f"\nYahoo Finance 조회: {len(rows_by_sym)}개 티커")
+        ok = fail = skipped = 0
+
+        def pending_updates():
+            nonlocal fail, skipped
+            fetched = set()
+            for qf in as_completed(futures):
+                try:
+                    part = qf.result()
+                except Exception as e:
+                    log.error(f"Yahoo Finance 조회 실패: {e}")
+                    sys.exit(1)
+                fetched.update(part)
+                for sym, info in part.items():
+                    for i, pid, old in rows_by_sym.get(sym, ()):
+                        if is_unchanged(old, info, usdkrw, now):
+                            skipped += 1
+                            continue
+                        yield (i, sym, info), pid, info
+            log.info(f"조회 완료: {len(fetched)}개 성공\n")
+
+            for sym, sym_rows in rows_by_sym.items():
+                if sym in fetched:
+                    continue
+                for i, *_ in sym_rows:
+                    log.info(f"[{i}/{total_rows}] {sym} ✗ 데이터 없음/오류")
+                    fail += 1
+
+        for (i, sym, info), err in bulk_update_pages(notion, pending_updates(), usdkrw, now_iso):
+            if err:
+                log.info(f"[{i}/{total_rows}] {sym} ✗ Notion 업데이트 실패: {err}")
+                quote_cache.invalidate(sym)
+                fail += 1
+                continue
             mcap_log = f" | 시총 {info['marketCap']}억" if info["marketCap"] > 0 else ""
             fx_log = f" | USDKRW {usdkrw:.2f}" if isinstance(usdkrw, (int, float)) else ""
-            print(f"[{i}/{len(rows)}] {sym} ✓ {info['currentPrice']:.2f} ({chg:+.2f}%){mcap_log}{fx_log} | {info.get('name','')}")
+            name_log = f" | {info['name']}" if info["name"] else ""
+            log.info(f"[{i}/{total_rows}] {sym} ✓ {info['currentPrice']:.2f} ({info['changePct']:+.2f}%){mcap_log}{fx_log}{name_log}")
             ok += 1
-        except Exception as e:
-            print(f"[{i}/{len(rows)}] {sym} ✗ Notion 업데이트 실패: {e}")
-            fail += 1
 
-    print("\n=== 완료 ===")
-    print(f"성공: {ok} | 실패: {fail} | 총: {len(rows)}")
+    quote_cache.save()
+
+    log.info("\n=== 완료 ===")
+    log.info(f"성공: {ok} | 변동 없음: {skipped} | 실패: {fail} | 총: {total_rows}")
 
 if __name__ == "__main__":
-    main()
+    setup_logging()
+    try:
+        main()
+    finally:
+        logging.shutdown()
 